@@ -10,27 +10,37 @@
 # 
 ############################################################
 
-import arcpy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from pathlib import Path
 from enum import Enum
 from typing import Union
-from datetime import datetime
+from datetime import datetime, timezone
 import time
 import re
+import string
 import logging
 from logging.handlers import RotatingFileHandler
-from json.decoder import JSONDecodeError
 import argparse
-import zipfile
-import tempfile
+import hashlib
+import heapq
 import os
 import configparser
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 config = configparser.ConfigParser()
-arcpy.env.overwriteOutput = True
+arcpy = None  # imported by importArcpy() once it is actually needed
 current_dir = Path.cwd()
 script_path = Path(__file__).resolve()
 script_dir = script_path.parent
@@ -38,6 +48,31 @@ logs_directory = script_dir / "logs"
 logs_directory.mkdir(parents=True, exist_ok=True)
 logger = None
 
+# Matchers for the top level members of a WFS GeoJSON FeatureCollection.
+_NUMBER_RETURNED_RE = re.compile(rb'"numberReturned"\s*:\s*(\d+)')
+_TIMESTAMP_RE = re.compile(rb'"timeStamp"\s*:\s*"([^"]*)"')
+_FEATURES_START_RE = re.compile(r'"features"\s*:\s*\[')
+# Matches arcpy errors caused by a schema or edit lock, either by the
+# word lock(s)/locked or by the ESRI error codes for exclusive locks.
+_LOCK_ERROR_RE = re.compile(r"\block(s|ed)?\b|\b(000464|000496)\b", re.IGNORECASE)
+_spatial_references = {}
+NZTM_WKID = 2193  # NZGD2000 / New Zealand Transverse Mercator, used for the extent
+_json_cache = {}
+# Field types that are never copied between feature classes by name.
+# The geometry is copied separately with SHAPE@.
+_NON_COPY_FIELD_TYPES = frozenset(("OID", "Geometry", "GlobalID"))
+
+class _SlugTable(dict):
+    """A str.translate table that deletes any character not listed."""
+    def __missing__(self, key):
+        return None
+
+# Used by slugify. ASCII letters, digits and underscores are kept, invalid
+# file name characters, hyphens and spaces become underscores, and anything
+# else is removed, all in one str.translate pass.
+_SLUG_TABLE = _SlugTable({ord(c): c for c in string.ascii_letters + string.digits + "_"})
+_SLUG_TABLE.update({ord(c): "_" for c in '-<>:"/\\|?* '})
+
 def configureLogging(log_dir):
     """
     Set up a logger to a logfile and standard out.
@@ -74,6 +109,111 @@ def configureLogging(log_dir):
     logger.addHandler(consoleHandler)
     return logger
 
+def importArcpy():
+    """
+    Import arcpy on first use. Importing arcpy checks out a
+    license and takes several seconds, which isn't needed for
+    things like --help or a missing settings file.
+    """
+    global arcpy
+    if arcpy is None:
+        import arcpy as _arcpy
+        _arcpy.env.overwriteOutput = True
+        arcpy = _arcpy
+    return arcpy
+
+def loadJson(path, use_cache=True):
+    """
+    Read a JSON file, using orjson if it is installed.
+    Small state files are cached by path so they are only read
+    once per run. Pass use_cache=False for one-off reads.
+    """
+    path = Path(path)
+    if use_cache and path in _json_cache:
+        return _json_cache[path]
+    if orjson is not None:
+        data = orjson.loads(path.read_bytes())
+    else:
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+    if use_cache:
+        _json_cache[path] = data
+    return data
+
+def saveJson(path, data):
+    """
+    Write data to a JSON file, using orjson if it is installed,
+    and refresh the cached copy read by loadJson.
+    """
+    path = Path(path)
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(data))
+    else:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+    _json_cache[path] = data
+
+def dumpsJson(data):
+    """
+    Serialise data to a JSON string, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data)
+
+def getSpatialReference(wkid):
+    """
+    Return the spatial reference for a well-known id.
+    Each one is created once and then reused.
+    """
+    if wkid not in _spatial_references:
+        _spatial_references[wkid] = arcpy.SpatialReference(wkid)
+    return _spatial_references[wkid]
+
+def getWgs84SpatialReference():
+    """
+    Return the WGS84 (4326) spatial reference used for LINZ
+    request geometries.
+    """
+    return getSpatialReference(4326)
+
+def parseLinzDatetime(value):
+    """
+    Convert a LINZ date string (e.g. 2024-06-20T01:31:30Z) to a
+    datetime. None and datetime values are returned unchanged.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return _parseLinzDatetimeString(value)
+
+def formatLinzDatetime(value=None):
+    """
+    Format a datetime as a LINZ date string (e.g. 2024-06-20T01:31:30Z),
+    defaulting to now if value is None. Strings are parsed first.
+    Aware datetimes are converted to UTC first and naive ones are
+    taken to already be UTC.
+    """
+    if value is None:
+        value = datetime.now(timezone.utc)
+    elif isinstance(value, str):
+        value = parseLinzDatetime(value)
+    elif not isinstance(value, datetime):
+        raise TypeError(f"Expected a datetime or LINZ date string, got {type(value).__name__}")
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+@lru_cache(maxsize=65536)
+def _parseLinzDatetimeString(value):
+    """
+    fromisoformat is much quicker than strptime, but before Python 3.11
+    it doesn't accept the trailing Z, so that is trimmed off first.
+    Cached because the same timestamps repeat across many rows.
+    """
+    if value.endswith("Z"):
+        value = value[:-1]
+    return datetime.fromisoformat(value)
+
 def init(args):
     """
     Initialise the script, read settings and configuration
@@ -99,6 +239,7 @@ def init(args):
         raise ValueError(f'No config section found for {args.name}. Please update configuration file.')
 
     settings = config[args.name]
+    importArcpy()
 
     _action = ActionToTake.INIT
     _export_id = None
@@ -128,7 +269,7 @@ def init(args):
         purge = args.purge
         )
 
-    logger.debug(f"..............Script initialised..................")
+    logger.debug("..............Script initialised..................")
     return linz_dataset
 
 class ActionToTake(Enum):
@@ -163,14 +304,28 @@ class LINZDataset:
     layer_download_url = "https://data.linz.govt.nz/services/api/v1.x/layers/"
     last_updated_datetime = None
     extent_geometry = None
+    extent_geometry_read = False
+    extent_geometry_wgs84 = None
+    _wfs_params = None
     extent = None
     staging_fgb_name = "staging.gdb"
     full_download_file = None
     layer_feature_class = None
     changeset_file = None 
     changeset_fc = None 
+    changes_to = None
     purge = False
     proxies = None 
+    request_timeout = (5, 60)  # (connect, read) seconds
+    compact_growth_ratio = 1.25
+    sql_batch_size = 1000  # ids per "IN (...)" where clause
+    row_count_check_interval = 10  # changeset runs between GetCount checks
+    row_count = None
+    runs_since_row_count = 0
+    compact_max_age = 7 * 24 * 60 * 60  # seconds
+    compact_after_changes = 100000  # changesets this large are always followed by a compact
+    max_download_workers = 16  # upper limit for the download_workers setting
+    max_tiles = 256  # most tiles a changeset request can be split into
     
     def __init__(
         self,        
@@ -206,7 +361,7 @@ class LINZDataset:
 
         self.layer_id = self.settings.get("layer_id")
         self.id_field = self.settings.get("id_field")
-        self.wkid = self.settings.getint("wkid", 2193)
+        self.wkid = self.settings.getint("wkid", NZTM_WKID)
         self.sql_filter = self.settings.get("sql_filter")
 
         _data_directory = self.settings.get("data_directory")
@@ -220,6 +375,8 @@ class LINZDataset:
         self.fulldownload_directory = self.layer_data_directory / "full"
         self.last_updated_file = self.layer_data_directory / "last_updated.json"
         self.staging_fgb = self.layer_data_directory / self.staging_fgb_name
+        self.last_compact_file = self.layer_data_directory / "last_compact.json"
+        self.tile_cache_directory = self.layer_data_directory / "tilecache"
         self.layer_feature_class = self.layer_data_directory / self.staging_fgb_name / f"layer_{self.layer_id}"
         self.extent_featureclass = self.staging_fgb / "extent"
         
@@ -227,7 +384,16 @@ class LINZDataset:
         self.max_polling_time = self.settings.getint("max_polling_time", 600) #seconds
         self.retain_after_purge = self.settings.getint("retain_after_purge", 5)
         self.initial_buffer = self.settings.getint("initial_buffer", 1000)  #meters
-        _proxies = self.settings.get("proxies", None)
+        self.max_tile_area = self.settings.getfloat("max_tile_area", 0)  #square kilometers
+        self.download_workers = self.settings.getint("download_workers", 4)
+        if not 1 <= self.download_workers <= self.max_download_workers:
+            raise LINZError(
+                f"download_workers must be between 1 and {self.max_download_workers}, got {self.download_workers}."
+            )
+        if self.max_tile_area < 0:
+            raise LINZError(
+                f"max_tile_area must be 0 (no tiling) or a positive number of square kilometers, got {self.max_tile_area}."
+            )
         if self.settings.get("http_proxy") or self.settings.get("https_proxy"):
             self.proxies = {
                 "http": self.settings.get("http_proxy", ""),
@@ -235,6 +401,30 @@ class LINZDataset:
             }
             self.logger.info(self.proxies)
 
+        self._describe_cache = {}
+
+        # One pooled session for all LINZ requests so the connection
+        # (and TLS handshake) is reused, e.g. across the polling loop.
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        if self.proxies:
+            self.session.proxies.update(self.proxies)
+        # Only GET requests are retried, so creating an export is never
+        # repeated. Once the retries run out the last response is returned
+        # and its status code is checked as before.
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max(8, self.download_workers),
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+
         self.logger.info(f"LINZDataset initialized.")
 
     def __str__(self):
@@ -266,35 +456,47 @@ class LINZDataset:
 
     @property 
     def wfs_params(self) -> dict:
-        """Return dictionary of WFS parameters"""
-        bbox_string = None        
-        cql_filter = self.settings.get("cql_filter", None)
-        if cql_filter is None:
-            ## cql_filter and bbox cannot be used together.
-            self.getExtentGeometry()
-            if self.extent_geometry is not None:
-                bbox_string = self.geometryToBboxString(self.extent_geometry)
-        return {
-                "service": "WFS",
-                "version": "2.0.0",
-                "typename": f"layer-{self.layer_id}-changeset",
-                "request": "GetFeature",
-                "srsname": f"EPSG:{self.wkid}",
-                "outputFormat": "json",
-                "cql_filter": cql_filter,
-                "bbox": bbox_string,
-            }
+        """
+        Return dictionary of WFS parameters.
+        These are worked out on first use and a copy returned each time,
+        so callers can add to it without changing the cached values.
+        """
+        if self._wfs_params is None:
+            bbox_string = None
+            cql_filter = self.settings.get("cql_filter", None)
+            if cql_filter is None:
+                ## cql_filter and bbox cannot be used together.
+                extent_geometry_wgs84 = self.getExtentGeometryWgs84()
+                if extent_geometry_wgs84 is not None:
+                    bbox_string = self.geometryToBboxString(
+                        extent_geometry_wgs84, already_wgs84=True
+                    )
+            self._wfs_params = {
+                    "service": "WFS",
+                    "version": "2.0.0",
+                    "typename": f"layer-{self.layer_id}-changeset",
+                    "request": "GetFeature",
+                    "srsname": f"EPSG:{self.wkid}",
+                    "outputFormat": "json",
+                    "cql_filter": cql_filter,
+                    "bbox": bbox_string,
+                }
+        return dict(self._wfs_params)
 
     @property
     def number_of_changes(self) -> int:
         """
         Returns the number of changes in the current changeset file.
+        Only numberReturned is read, the features are not parsed.
         """
         if not self.changeset_file.is_file():
             return 0
-        with open(self.changeset_file, "r", encoding="utf-8") as file:
-            data = json.load(file)
-        return int(data.get("numberReturned", 0))
+        number_returned, _ = self.readChangesetHeader(self.changeset_file)
+        if number_returned is None:
+            raise LINZError(
+                f"numberReturned not found in changeset file: {self.changeset_file}. Check the file for error messages."
+            )
+        return number_returned
 
     def timing_decorator(func):
         """
@@ -307,11 +509,32 @@ class LINZDataset:
             end_time = time.time()
             elapsed_time = end_time - start_time
             self.logger.debug(
-                f"Function '{func.__name__}' took {elapsed_time:.4f} seconds to complete."
+                "Function '%s' took %.4f seconds to complete.", func.__name__, elapsed_time
             )
             return result
         return wrapper
 
+    def retry_on_lock(func):
+        """
+        A helper wrapper function to retry other functions up to 3 times,
+        a second apart, if they fail because a lock couldn't be acquired.
+        Only arcpy errors that mention a lock are retried.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self = args[0]
+            for attempt in range(1, 4):
+                try:
+                    return func(*args, **kwargs)
+                except (arcpy.ExecuteError, RuntimeError) as e:
+                    if attempt == 3 or not _LOCK_ERROR_RE.search(str(e)):
+                        raise
+                    self.logger.warning(
+                        f"Function '{func.__name__}' could not acquire a lock, retrying: {e}"
+                    )
+                    time.sleep(1)
+        return wrapper
+
     @timing_decorator
     def test(self, stuff):
         self.logger.info("testing")
@@ -338,27 +561,37 @@ class LINZDataset:
         Process a zip file from a full download of data.
         """
         self.copy_fc_to_staging(zip_path=self.full_download_file)
-        self.deleteFeaturesNotIntersectingExtent(self.layer_feature_class)
-        self.deleteFeaturesNotMatchingSQL(self.layer_feature_class)
+        self.deleteFeaturesNotMatching(self.layer_feature_class)
+        self.indexIdField(self.layer_feature_class)
         self.update_last_updated_file()
         if self.purge:
             self.purgeChangesets()
+        # Compact once the writes and purge are done, to tidy up after them.
+        self.compactIfNeeded()
 
     def requestChangeset(self):
         self.downloadChangeSet()
         self.processChangeSet()
 
     def processChangeSet(self):
-        if self.number_of_changes > 0: 
+        # Read before the purge, which may remove the changeset file.
+        number_of_changes = self.number_of_changes
+        if number_of_changes > 0: 
             self.convertJsonToFGB()
-            self.deleteFeaturesNotIntersectingExtent(self.changeset_fc)
-            self.deleteFeaturesNotMatchingSQL(self.changeset_fc)
+            self.deleteFeaturesNotMatching(self.changeset_fc)
+            self.indexIdField(self.changeset_fc, unique=False)
+            # The id IN (...) batches in applyChangeset rely on this index.
+            # It is normally already there from the full download.
+            self.indexIdField(self.layer_feature_class)
             self.applyChangeset()
-            self.update_last_updated_file()
+            self.update_last_updated_file(self.changes_to)
         else:
             self.logger.warning("There were no changes in the changeset file to process.")
         if self.purge:
             self.purgeChangesets()
+        # Compact once the writes and purge are done, to tidy up after them.
+        # A large changeset leaves a lot of free space behind, so always compact after one.
+        self.compactIfNeeded(force=number_of_changes >= self.compact_after_changes)
 
     def prepare(self):
         """
@@ -371,9 +604,6 @@ class LINZDataset:
         if not arcpy.Exists(str(self.staging_fgb)):
             self.logger.debug("Staging file geodatabase didn't exist, creating it now.")
             arcpy.management.CreateFileGDB(str(self.layer_data_directory), self.staging_fgb_name)
-        else:
-            # Compact the file geodatabase to give best performance for upcoming edits.
-            arcpy.management.Compact(str(self.staging_fgb))
 
         if not arcpy.Exists(str(self.extent_featureclass)):
             arcpy.management.CreateFeatureclass(
@@ -382,10 +612,45 @@ class LINZDataset:
                 geometry_type="POLYGON",
                 has_m="DISABLED",
                 has_z="DISABLED",
-                spatial_reference='PROJCS["NZGD_2000_New_Zealand_Transverse_Mercator",GEOGCS["GCS_NZGD_2000",DATUM["D_NZGD_2000",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",1600000.0],PARAMETER["False_Northing",10000000.0],PARAMETER["Central_Meridian",173.0],PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]];-2147483647 -2147483647 20000;-100000 10000;-100000 10000;0.0001;0.001;0.001;IsHighPrecision',
+                spatial_reference=getSpatialReference(NZTM_WKID),
             )
         return
 
+    def compactIfNeeded(self, force=False):
+        """
+        Compact the staging file geodatabase, but only if it has grown
+        by more than compact_growth_ratio since it was last compacted,
+        or it hasn't been compacted for compact_max_age seconds,
+        or force is True.
+        Compact rewrites the whole geodatabase, so running it on
+        every run is wasted effort for a small changeset.
+        The size and time of the last compact are kept in last_compact.json.
+        """
+        size = sum(p.stat().st_size for p in self.staging_fgb.rglob("*") if p.is_file())
+        last_compact = {}
+        if self.last_compact_file.is_file():
+            try:
+                last_compact = loadJson(self.last_compact_file)
+            except ValueError:
+                last_compact = {}
+
+        last_size = last_compact.get("size", 0)
+        last_time = last_compact.get("time", 0)
+        if (
+            not force
+            and last_size
+            and size <= last_size * self.compact_growth_ratio
+            and time.time() - last_time < self.compact_max_age
+        ):
+            self.logger.debug("Skipping compact, staging file geodatabase is %s bytes.", size)
+            return False
+
+        self.logger.debug("Compacting staging file geodatabase (%s bytes).", size)
+        arcpy.management.Compact(str(self.staging_fgb))
+        size = sum(p.stat().st_size for p in self.staging_fgb.rglob("*") if p.is_file())
+        saveJson(self.last_compact_file, {"size": size, "time": time.time()})
+        return True
+
     @timing_decorator
     def initiate_export(self):
         """
@@ -394,9 +659,8 @@ class LINZDataset:
         """
         self.logger.info("Downloading a full dataset as file geodatabase.")
         self.prepare()
-        params = self.wfs_params
         data = {
-            "crs": params["srsname"],
+            "crs": f"EPSG:{self.wkid}",
             "items": [
                 {"item": f"{self.layer_download_url}{self.layer_id}/"}
             ],
@@ -407,12 +671,15 @@ class LINZDataset:
         if self.extent_geometry is not None:
             # The export API crops features, so we buffer now and clean up later.
             buffered_extent = self.extent_geometry.buffer(self.initial_buffer).extent.polygon
-            geojson_extent = self.geometryToGeojson(buffered_extent)
+            buffered_extent = buffered_extent.projectAs(getWgs84SpatialReference())
+            geojson_extent = self.geometryToGeojson(buffered_extent, already_wgs84=True)
             data["extent"] = geojson_extent
         self.logger.debug(data)
 
         # Send a validate request to LINZ to check for errors
-        response = requests.post(self.validation_url, headers=self.headers, json=data)
+        response = self.session.post(
+            self.validation_url, json=data, timeout=self.request_timeout
+        )
         if response.status_code in (200, 201, "200", "201"):
             try:
                 json_response = response.json()
@@ -434,8 +701,10 @@ class LINZDataset:
         self.logger.debug("Export parameters passed LINZ validation check.")
 
         # Make the actual request to LINZ for the fgb to be generated.
-        self.last_updated_datetime = datetime.utcnow()
-        response = requests.post(self.requests_url, headers=self.headers, json=data)
+        self.last_updated_datetime = datetime.now(timezone.utc)
+        response = self.session.post(
+            self.requests_url, json=data, timeout=self.request_timeout
+        )
         if response.status_code in (200, 201, "200", "201"):
             try:
                 json_response = response.json()
@@ -460,58 +729,77 @@ class LINZDataset:
         it when finished.
         """
         self.logger.info(
-            f"Downloading {self.export_id}. Polling every {self.poll_interval} seconds for a maximum of {self.max_polling_time} seconds"
+            f"Downloading {self.export_id}. Polling at most every {self.poll_interval} seconds for a maximum of {self.max_polling_time} seconds"
         )
 
-        start_time = time.time()
+        start_time = time.monotonic()
         status_url = f"https://data.linz.govt.nz/services/api/v1.x/exports/{self.export_id}/"
         download_url = f"{status_url}download/"
 
         attempt = 0
+        progress = 0.0
+        sleep_seconds = None
+        etag = None
 
-        while (time.time() - start_time) < self.max_polling_time:
+        while (time.monotonic() - start_time) < self.max_polling_time:
             attempt += 1
-            poll_response = requests.get(status_url, headers=self.headers)
+            # Send the last ETag, so an unchanged status comes back as an empty 304.
+            poll_response = self.session.get(
+                status_url,
+                headers={"If-None-Match": etag} if etag else None,
+                timeout=self.request_timeout,
+            )
 
-            if poll_response.status_code not in (200, 201, "200", "201"):
+            if poll_response.status_code == 304:
+                self.logger.debug("Polling attempt: %s, status unchanged", attempt)
+                previous_progress = progress
+            elif poll_response.status_code not in (200, 201, "200", "201"):
                 self.logger.error(
                     f"Polling failed with status code: {poll_response.status_code}"
                 )
                 self.logger.error(f"Polling Response Content: {poll_response.text}")
                 break
-            try:
-                poll_json_response = poll_response.json()
-                state = poll_json_response.get("state")
-                progress = round(float(poll_json_response.get("progress")), 2)
-
-                if state == "complete":
-                    self.logger.debug(f"Polling successful. State: {state}")
+            else:
+                etag = poll_response.headers.get("ETag")
+                try:
+                    poll_json_response = poll_response.json()
+                    state = poll_json_response.get("state")
+                    previous_progress = progress
+                    progress = round(float(poll_json_response.get("progress") or 0), 2)
+
+                    if state == "complete":
+                        self.logger.debug("Polling successful. State: %s", state)
+                        break
+                    else:
+                        self.logger.debug(
+                            "Polling attempt: %s, Progress: %s, State: %s", attempt, progress, state
+                        )
+                except ValueError as e:
+                    self.logger.error(f"Error parsing polling JSON: {e}")
                     break
-                else:
-                    self.logger.debug(
-                        f"Polling attempt: {attempt}, Progress: {progress}, State: {state}"
-                    )
-            except ValueError as e:
-                self.logger.error(f"Error parsing polling JSON: {e}")
-                break
 
-            time.sleep(self.poll_interval)
+            sleep_seconds = self.nextPollInterval(
+                attempt,
+                progress,
+                previous_progress,
+                sleep_seconds,
+                poll_response.headers.get("Retry-After"),
+            )
+            time.sleep(sleep_seconds)
         else:
-            err = "Polling finished: reached the limit of attempts or time. If necessary, consider increasing these limits in the configuration file. You can resume polling for this export by using --resume {self.export_id}."
+            err = f"Polling finished: reached the limit of attempts or time. If necessary, consider increasing these limits in the configuration file. You can resume polling for this export by using --resume {self.export_id}."
             logger.error(err)
             raise LINZError(err)
 
-        datetime_suffix = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        datetime_suffix = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
         download_dir = self.layer_data_directory / "full"
         self.ensure_folder(download_dir)
         self.full_download_file = download_dir / f"layer_{self.layer_id}_{datetime_suffix}.zip"
-        response = requests.get(download_url, headers=self.headers, stream=True)
+        response = self.session.get(
+            download_url, stream=True, timeout=self.request_timeout
+        )
         if response.status_code in (200, 201, "200", "201"):
-            # Open a local file in write-binary mode
-            with open(self.full_download_file, "wb") as file:
-                # Iterate over the response content in chunks
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
+            self.streamResponseToFile(response, self.full_download_file)
         else:
             err = f"Failed to download file. Status code: {response.status_code}. Response Content: {response.text}"
             self.logger.error(err)       
@@ -520,38 +808,81 @@ class LINZDataset:
         self.logger.info(f"Export downloaded to zip file: {self.full_download_file}")        
         return self.full_download_file
 
+    def nextPollInterval(
+        self, attempt, progress, previous_progress, previous_sleep, retry_after=None
+        ):
+        """
+        Work out how many seconds to wait before polling an export again.
+        A Retry-After header from LINZ always takes precedence.
+        While the export has barely started, back off exponentially.
+        Once it is progressing, estimate the time remaining from the
+        rate of progress and wait a fraction of that, so the download
+        starts soon after the export completes.
+        Never waits longer than poll_interval.
+        """
+        if retry_after:
+            try:
+                return max(1.0, float(retry_after))
+            except ValueError:
+                pass
+
+        if progress > 0.9:
+            return min(2.0, self.poll_interval)
+        if progress < 0.05 or not previous_sleep:
+            return max(1.0, min(self.poll_interval, 2 ** attempt))
+
+        rate = max(progress - previous_progress, 0.001) / previous_sleep
+        remaining = (1.0 - progress) / rate
+        return max(1.0, min(self.poll_interval, remaining * 0.3))
+
     def copy_fc_to_staging(self, zip_path):
         """
         zip_path will be a Path object pointing to the
         downloaded zip file containing the file geodatabase.
-        Extract to temp location, copy the feature class
-        within it to the staging.gdb and then delete
-        the temp data.
+        Extract just the file geodatabase to a folder next to the
+        staging.gdb, copy the feature class within it to the
+        staging.gdb and then delete the extracted data.
+        Copy duplicates the feature class as it is rather than
+        rewriting it row by row like ExportFeatures does.
         """
+        import zipfile
+
         self.logger.info(f"Copying feature class to staging file geodatabase")
-        # Create a temporary directory in the same directory as the zip file
         if isinstance(zip_path, str):
             zip_path = Path(zip_path)
-        with tempfile.TemporaryDirectory(dir=zip_path.parent) as temp_dir:
-            temp_path = Path(temp_dir)
-
-            # Extract the zip file to the temporary directory
+        extract_path = self.layer_data_directory / "full_extract"
+        if extract_path.exists():
+            shutil.rmtree(extract_path)
+        extract_path.mkdir(parents=True)
+        try:
+            # Extract only the members of the first file geodatabase in the zip.
             with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                zip_ref.extractall(temp_path)
+                members = zip_ref.namelist()
+                gdb_prefix = next(
+                    (m[: m.lower().index(".gdb/") + 5] for m in members if ".gdb/" in m.lower()),
+                    None,
+                )
+                if gdb_prefix is None:
+                    raise LINZError(f"No file geodatabase found in {zip_path}")
+                zip_ref.extractall(
+                    extract_path, [m for m in members if m.startswith(gdb_prefix)]
+                )
 
-            # get list of file geodatabases in the temp folder. get the first one.
-            arcpy.env.workspace = temp_dir
-            gdb = arcpy.ListWorkspaces("*", "FileGDB")[0]
+            gdb = str(extract_path / gdb_prefix.rstrip("/"))
             self.logger.debug(gdb)
             arcpy.env.workspace = gdb
             in_features = arcpy.ListFeatureClasses()[0]
-            self.logger.debug(in_features)            
+            self.logger.debug(in_features)
 
-            arcpy.conversion.ExportFeatures(
-                in_features=in_features, out_features=str(self.layer_feature_class)
+            arcpy.management.Copy(
+                in_data=in_features, out_data=str(self.layer_feature_class)
             )
+            self.forgetDescribe(self.layer_feature_class)
             arcpy.management.Delete(gdb)
-            self.convertIdFieldToInteger(self.layer_feature_class)
+        finally:
+            arcpy.env.workspace = None
+            shutil.rmtree(extract_path, ignore_errors=True)
+        self.convertIdFieldToInteger(self.layer_feature_class)
         return self.layer_feature_class
 
 
@@ -564,54 +895,197 @@ class LINZDataset:
         if self.last_updated_file is None or not self.last_updated_file.is_file():
             raise LINZError(f"Processing a changeset requires knowing a date to retrieve changes from. Please run a full download or manually resolve this before attempting a changeset.")
         else:
-            with open(self.last_updated_file, "r") as file:
-                last_updated_data = json.load(file)
+            last_updated_data = loadJson(self.last_updated_file)
 
         changes_from = last_updated_data.get("last_updated", None)
         if not changes_from:
             raise LINZError(f"Error getting last updated time from file. Cannot generate changeset, please reset using a full download.")            
 
-        now_utc = datetime.utcnow()
-        changes_to = f"{now_utc.isoformat()}Z"
-        self.logger.debug(f"Changes date range (UTC): from:{changes_from};to:{changes_to}")
-
         params = self.wfs_params
+        tiles = self.getBboxTiles() if params["bbox"] is not None else []
+
+        # A tiled download that didn't finish last time is resumed over the
+        # same date range, so the tiles already in the cache can be reused.
+        self.changes_to = None
+        if len(tiles) > 1:
+            self.changes_to = self.resumeTileCacheWindow(changes_from)
+        if self.changes_to is None:
+            self.changes_to = datetime.now(timezone.utc)
+        changes_to = formatLinzDatetime(self.changes_to)
+        self.logger.debug("Changes date range (UTC): from:%s;to:%s", changes_from, changes_to)
+
         params["viewparams"] = f"from:{changes_from};to:{changes_to}"
-        datetime_suffix = now_utc.strftime("%Y%m%dT%H%M%S")
+        datetime_suffix = self.changes_to.strftime("%Y%m%dT%H%M%S")
         self.changeset_directory.mkdir(parents=True, exist_ok=True)
         self.changeset_file = self.changeset_directory / f"layer_{str(self.layer_id)}_{datetime_suffix}.json"
 
         self.logger.debug(params)
-        # Make the request and stream the response to a file
-        response = requests.get(
-            self.wfs_url,
-            headers=self.headers,
-            params=params,
-            stream=True,
-            proxies=self.proxies,
-        )
-        with open(self.changeset_file, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        if len(tiles) > 1:
+            self.tile_cache_directory.mkdir(parents=True, exist_ok=True)
+            saveJson(
+                self.tile_cache_directory / "window.json",
+                {"from": changes_from, "to": changes_to},
+            )
+            self.downloadTiledChangeSet(params, tiles)
+        else:
+            # Make the request and stream the response to a file
+            response = self.session.get(
+                self.wfs_url,
+                params=params,
+                stream=True,
+                timeout=self.request_timeout,
+            )
+            self.streamResponseToFile(response, self.changeset_file)
         self.logger.info(f"WFS data download complete and saved to: {self.changeset_file}.")
 
-        try:
-            # Get the timeStamp to return
-            with open(self.changeset_file, "r", encoding="utf-8") as file:
-                data = json.load(file)
-            self.last_updated_datetime = data.get("timeStamp", None)
-            #self.number_of_changes = int(data.get("numberReturned", 0))
-            # if int(data.get("numberReturned", 0)) == 0:
-            #     self.logger.info(
-            #         "There were no features in the download. Skipping applying any updates."
-            #     )
-            #     return None
-            del data
-            self.logger.debug(f"Timestamp of downloaded data: {self.last_updated_datetime}")
-        except JSONDecodeError as jErr:
+        # Only the header members are needed here, so avoid parsing the
+        # whole FeatureCollection. convertJsonToFGB reads the features later.
+        number_returned, self.last_updated_datetime = self.readChangesetHeader(self.changeset_file)
+        if number_returned is None:
             raise LINZError(
                 f"Error encountered parsing the downloaded data. Check the download file for error messages."
             )
+        self.logger.debug("Number of features returned: %s", number_returned)
+        self.logger.debug("Timestamp of downloaded data: %s", self.last_updated_datetime)
+        return self.changeset_file
+
+    def downloadTiledChangeSet(self, params, tiles):
+        """
+        Download the changeset as one WFS request per bbox tile,
+        running the requests concurrently, then merge the parts
+        into the changeset file.
+        Each tile is saved in the tile cache keyed by its bbox and date
+        range, so if a run fails part way the tiles already downloaded
+        are reused. Only tiles with a numberReturned are cached or reused.
+        The cache is cleared once the parts are merged.
+        """
+        self.logger.info(
+            f"Downloading changeset as {len(tiles)} tiles using {self.download_workers} workers."
+        )
+        self.tile_cache_directory.mkdir(parents=True, exist_ok=True)
+        viewparams = params["viewparams"]
+        part_files = [
+            self.tile_cache_directory
+            / f"{hashlib.sha1(f'{tile}|{viewparams}'.encode()).hexdigest()}.json"
+            for tile in tiles
+        ]
+
+        def download_part(tile, part_file):
+            if part_file.is_file():
+                if self.readChangesetHeader(part_file)[0] is not None:
+                    self.logger.debug("Using cached tile %s from %s", tile, part_file)
+                    return
+                self.logger.warning(f"Cached tile {part_file} is not a complete changeset, downloading it again.")
+                part_file.unlink()
+            response = self.session.get(
+                self.wfs_url,
+                params={**params, "bbox": tile},
+                stream=True,
+                timeout=self.request_timeout,
+            )
+            if response.status_code != 200:
+                err = f"Failed to download tile {tile}. Status code: {response.status_code}. Response Content: {response.text}"
+                self.logger.error(err)
+                raise LINZError(err)
+            # Only complete downloads are renamed into the cache.
+            temp_file = part_file.with_suffix(".tmp")
+            self.streamResponseToFile(response, temp_file)
+            if self.readChangesetHeader(temp_file)[0] is None:
+                temp_file.replace(part_file.with_suffix(".error"))
+                raise LINZError(
+                    f"Error encountered parsing the downloaded data. Check {part_file.with_suffix('.error')} for error messages."
+                )
+            temp_file.replace(part_file)
+            self.logger.debug("Downloaded tile %s to %s", tile, part_file)
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [
+                executor.submit(download_part, tile, part_file)
+                for tile, part_file in zip(tiles, part_files)
+            ]
+            for future in futures:
+                future.result()
+
+        self.mergeChangesetParts(part_files)
+        self.clearTileCache()
+        return self.changeset_file
+
+    def resumeTileCacheWindow(self, changes_from):
+        """
+        If the tile cache holds an unfinished download starting from
+        changes_from, return its end datetime so the same date range
+        is requested again. Otherwise clear out any stale tiles and
+        return None.
+        """
+        window_file = self.tile_cache_directory / "window.json"
+        if window_file.is_file():
+            window = loadJson(window_file, use_cache=False)
+            if window.get("from") == changes_from and window.get("to"):
+                self.logger.info(f"Resuming tiled changeset download up to {window['to']}")
+                return parseLinzDatetime(window["to"]).replace(tzinfo=timezone.utc)
+        self.clearTileCache()
+        return None
+
+    def clearTileCache(self):
+        """Delete all files in the tile cache directory."""
+        if not self.tile_cache_directory.is_dir():
+            return
+        for file in self.tile_cache_directory.iterdir():
+            try:
+                file.unlink()
+            except Exception as e:
+                self.logger.warning(f"Error deleting {file}: {e}")
+
+    def mergeChangesetParts(self, part_files):
+        """
+        Merge the per tile changeset files into a single GeoJSON
+        FeatureCollection at self.changeset_file.
+        Features crossing a tile boundary are returned by more than
+        one tile, so they are deduplicated using the id field.
+        Only one part is held in memory at a time.
+        """
+        seen = set()
+        number_returned = 0
+        time_stamp = None
+        crs = None
+        with open(self.changeset_file, "w", encoding="utf-8") as out:
+            out.write('{"type": "FeatureCollection", "features": [')
+            for part_file in part_files:
+                try:
+                    data = loadJson(part_file, use_cache=False)
+                except ValueError:
+                    data = None
+                if (
+                    not isinstance(data, dict)
+                    or "features" not in data
+                    or "numberReturned" not in data
+                ):
+                    # Keep a copy for troubleshooting, but don't reuse it from the tile cache.
+                    part_file.replace(part_file.with_suffix(".error"))
+                    raise LINZError(
+                        f"Error encountered parsing the downloaded data. Check {part_file.with_suffix('.error')} for error messages."
+                    )
+                time_stamp = time_stamp or data.get("timeStamp")
+                crs = crs or data.get("crs")
+                for feature in data["features"] or []:
+                    properties = feature.get("properties") or {}
+                    key = (properties.get(self.id_field), properties.get("__change__"))
+                    if key[0] is not None:
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    if number_returned:
+                        out.write(", ")
+                    out.write(dumpsJson(feature))
+                    number_returned += 1
+            out.write(f'], "numberReturned": {number_returned}, "timeStamp": {dumpsJson(time_stamp)}')
+            if crs is not None:
+                out.write(f', "crs": {dumpsJson(crs)}')
+            out.write("}")
+
+        for part_file in part_files:
+            part_file.unlink()
+        self.logger.debug("Merged %s tiles into %s features.", len(part_files), number_returned)
         return self.changeset_file
 
 
@@ -619,236 +1093,429 @@ class LINZDataset:
     def convertJsonToFGB(self):
         """
         The self.changeset_file should be geojson FeatureCollection.
-        Converts the json to feature class using the standard JSONToFeatures
-        GP tool.
+        If the layer feature class exists, the changeset feature class is
+        created with the same schema and the features are streamed into
+        it with an InsertCursor (see insertJsonFeatures).
+        Otherwise, converts the json to feature class using the standard
+        JSONToFeatures GP tool.
         Unfortunately, LINZ id fields are integers which the GP tool interprets
         as doubles. This makes data manipulation later on harder to perform. To cater for this,
-        the script copies the data to a temp field, deletes the original double id field,
-        recreates the id field as integer and copies the data back.
+        the id field is then converted to integer.
         """
 
         self.logger.info(f"Converting JSON data to feature class: {self.changeset_file}")
         datetime_suffix = str(Path(self.changeset_file).stem).split("_")[-1]
-        self.logger.debug(f"datetime_suffix is: {datetime_suffix}")
+        self.logger.debug("datetime_suffix is: %s", datetime_suffix)
         self.changeset_fc = (
             self.layer_data_directory
             / self.staging_fgb_name
             / f"layer_{self.layer_id}_changeset_{datetime_suffix}"
         )
+        if (
+            arcpy.Exists(str(self.layer_feature_class))
+            and self.describe(self.layer_feature_class).get("shapeType")
+            in ("Point", "Multipoint", "Polyline", "Polygon")
+        ):
+            self.insertJsonFeatures()
+            return self.changeset_fc
+
         with arcpy.EnvManager(
             outputZFlag="Disabled", outputMFlag="Disabled", overwriteOutput=True
         ):
             arcpy.conversion.JSONToFeatures(
                 in_json_file=str(self.changeset_file), out_features=str(self.changeset_fc)
             )
+        self.forgetDescribe(self.changeset_fc)
 
         self.convertIdFieldToInteger(self.changeset_fc)
 
+        # Store __change__ in upper case, as insertJsonFeatures does, so it
+        # can be filtered with a plain equality rather than LOWER().
+        with arcpy.da.UpdateCursor(str(self.changeset_fc), ["__change__"]) as cursor:
+            for row in cursor:
+                if row[0] and row[0] != row[0].upper():
+                    cursor.updateRow([row[0].upper()])
+
+        return self.changeset_fc
+
+    def insertJsonFeatures(self):
+        """
+        Create the changeset feature class using the layer feature class
+        as a template, so the id field is already an integer and date
+        fields are dates, then stream the GeoJSON features into it
+        with an InsertCursor.
+        This avoids the schema scan of JSONToFeatures and the follow up
+        id field conversion. __change__ values are stored in upper case.
+        """
+        changeset_fc = str(self.changeset_fc)
+        target_desc = self.describe(self.layer_feature_class)
+        arcpy.management.CreateFeatureclass(
+            out_path=str(self.changeset_fc.parent),
+            out_name=self.changeset_fc.name,
+            geometry_type=target_desc.get("shapeType").upper(),
+            template=str(self.layer_feature_class),
+            has_m="DISABLED",
+            has_z="DISABLED",
+            spatial_reference=getSpatialReference(self.wkid),
+        )
+        arcpy.management.AddField(
+            in_table=changeset_fc,
+            field_name="__change__",
+            field_type="TEXT",
+            field_length=10,
+        )
+        self.forgetDescribe(changeset_fc)
+
+        fields = [
+            f for f in arcpy.ListFields(changeset_fc)
+            if f.editable
+            and f.type not in _NON_COPY_FIELD_TYPES
+            and f.name != "__change__"
+        ]
+        field_names = [f.name for f in fields]
+        date_flags = [f.type == "Date" for f in fields]
+        property_keys = [None] * len(field_names)
+        known_keys = set()
+        lookup = {}
+
+        count = 0
+        with self.editSession(), arcpy.da.InsertCursor(
+            changeset_fc, ["SHAPE@", "__change__"] + field_names
+        ) as cursor:
+            for feature in self.iterGeojsonFeatures(self.changeset_file):
+                properties = feature.get("properties") or {}
+                if properties.keys() - known_keys:
+                    # Match fields to properties ignoring case. This is only
+                    # redone when a feature has a property not seen before,
+                    # e.g. when a DELETE only carries the id.
+                    known_keys.update(properties)
+                    lookup.update((key.lower(), key) for key in properties)
+                    property_keys = [lookup.get(name.lower()) for name in field_names]
+                geometry = feature.get("geometry")
+                row = [
+                    arcpy.AsShape(geometry) if geometry else None,
+                    (properties.get("__change__") or "").upper(),
+                ]
+                for key, is_date in zip(property_keys, date_flags):
+                    value = properties.get(key) if key is not None else None
+                    row.append(parseLinzDatetime(value) if is_date else value)
+                cursor.insertRow(row)
+                count += 1
+
+        self.logger.info(f"Inserted {count} features into {changeset_fc}")
         return self.changeset_fc
 
 
     @timing_decorator
+    @retry_on_lock
     def applyChangeset(self):
         """
         Both changeset and target_fc will be
         feature classes.
         Outputs feature counts to aid troubleshooting.
-        Uses the Append GP tool with upserts to apply changes.
+        Deletes, inserts and updates are applied within a single
+        edit session using arcpy.da cursors.
         """
-        #global editSession
-
         changeset = str(self.changeset_fc)
         target_fc = str(self.layer_feature_class)
 
-        count_changeset = int(arcpy.management.GetCount(changeset).getOutput(0))
-        count_target = int(arcpy.management.GetCount(target_fc).getOutput(0))
+        # Count the inserts, updates and deletes and collect the ids
+        # to delete in a single pass over the changeset.
+        change_counts = Counter()
+        delete_ids = []
+        upsert_ids = []
+        with arcpy.da.SearchCursor(changeset, ["__change__", self.id_field]) as cursor:
+            for change, record_id in cursor:
+                change = (change or "").upper()
+                change_counts[change] += 1
+                if change == "DELETE":
+                    delete_ids.append(record_id)
+                elif change in ("INSERT", "UPDATE"):
+                    upsert_ids.append(record_id)
+        count_changeset = sum(change_counts.values())
+        count_inserts = change_counts["INSERT"]
+        count_updates = change_counts["UPDATE"]
+        count_deletes = change_counts["DELETE"]
+
+        # The row count left by the last changeset is used rather than
+        # counting the target again. It is checked with GetCount every
+        # row_count_check_interval runs, or when there is no count saved.
+        last_updated_data = loadJson(self.last_updated_file) if self.last_updated_file.is_file() else {}
+        count_target = last_updated_data.get("row_count")
+        runs_since_row_count = last_updated_data.get("runs_since_row_count", 0) + 1
+        if count_target is None:
+            count_target = int(arcpy.management.GetCount(target_fc).getOutput(0))
+            runs_since_row_count = 0
 
         self.logger.info(f"Applying {count_changeset} changes from: {changeset}")
         self.logger.info(f"Applying changeset to: {target_fc}")
         self.logger.info(f"Number of rows in target before applying changes: {count_target}")
-
-        changeset_layername = "changeset_layer"
-        changeset_layer = arcpy.management.MakeFeatureLayer(changeset, changeset_layername)
-
-        # Get counts of inserts, updates and deletes. This has no functional purpose but
-        # is helpful for troubleshooting.
-
-        result = arcpy.management.SelectLayerByAttribute(
-            changeset_layername,
-            selection_type="NEW_SELECTION",
-            where_clause="__change__ = 'INSERT'",
-        )
-        count_inserts = int(result.getOutput(1))
         self.logger.info(f"Number of INSERT from the changeset: {count_inserts}")
-        result = arcpy.management.SelectLayerByAttribute(
-            changeset_layername,
-            selection_type="NEW_SELECTION",
-            where_clause="__change__ = 'UPDATE'",
-        )
-        count_updates = int(result.getOutput(1))
         self.logger.info(f"Number of UPDATE from the changeset: {count_updates}")
-        result = arcpy.management.SelectLayerByAttribute(
-            changeset_layername,
-            selection_type="NEW_SELECTION",
-            where_clause="__change__ = 'DELETE'",
-        )
-        count_deletes = int(result.getOutput(1))
         self.logger.info(f"Number of DELETE from the changeset: {count_deletes}")
-        arcpy.Delete_management(changeset_layer)
 
-        fields = [self.id_field]
-        where_clause = "LOWER(__change__) = 'delete'"
-        delete_ids = [
-            str(row[0])
-            for row in arcpy.da.SearchCursor(changeset, fields, where_clause=where_clause)
-        ]
-
-        if int(count_deletes) > 0:
-            self.logger.debug("Deleting records.")
-            delete_ids_string = ",".join(delete_ids)
-            where_clause = f"{self.id_field} in ({delete_ids_string})"
-            target_layername = "target_layer"
-            target_layer = arcpy.management.MakeFeatureLayer(
-                target_fc, target_layername, where_clause=where_clause
-            )
-
-            arcpy.management.DeleteRows(target_layer)
-            arcpy.Delete_management(target_layer)
-
-    ## NOTE: using the Append GP tool and match fields to do an upsert
-    ## didn't seem to reliably work. So changed to using an append plus
-    ## a custom applyUpdates function
-        if count_inserts > 0:
-            self.logger.debug("Inserting new records...")
-            arcpy.management.Append(
-                inputs=changeset,
-                target=target_fc,
-                schema_type="NO_TEST",
-                field_mapping=None,
-                subtype="",
-                expression="__change__ = 'INSERT'",
-                update_geometry="UPDATE_GEOMETRY",
-            )
-
-        if count_updates > 0:
-            self.logger.debug("Applying updates to existing records...")
-            self.processUpdates()
-
-        final_total = int(arcpy.management.GetCount(target_fc).getOutput(0))
-        self.logger.info(f"Number of rows in target after changes applied: {final_total}")
-
-        expected_total = count_target - count_deletes + count_inserts
-        if expected_total != final_total:
-            diff = expected_total - final_total
-            self.logger.warning(
-                f"Expected total of {expected_total} does not match actual final total {final_total}. Out by {diff}"
+        # One edit session, so the changes are committed together.
+        deleted = 0
+        inserted = 0
+        with self.editSession():
+            if count_deletes > 0:
+                self.logger.debug("Deleting records.")
+                # Delete in batches of ids, so a large changeset doesn't
+                # produce a where clause too long for the database.
+                # An UpdateCursor is used rather than the GP tools, which
+                # have a fixed cost per call and run outside the edit session.
+                for where_clause in self.idWhereClauses(target_fc, delete_ids):
+                    with arcpy.da.UpdateCursor(
+                        target_fc, [self.id_field], where_clause=where_clause
+                    ) as cursor:
+                        for _ in cursor:
+                            cursor.deleteRow()
+                            deleted += 1
+                self.logger.debug("Deleted %s records.", deleted)
+
+            ## NOTE: using the Append GP tool and match fields to do an upsert
+            ## didn't seem to reliably work. Inserts and updates are applied
+            ## with arcpy.da cursors instead.
+            if upsert_ids:
+                self.logger.debug("Inserting and updating records...")
+                inserted, _ = self.processUpserts(upsert_ids)
+
+        # Between GetCount checks the row count is kept from the cursor counts.
+        final_total = count_target - deleted + inserted
+        if runs_since_row_count >= self.row_count_check_interval:
+            actual_total = int(arcpy.management.GetCount(target_fc).getOutput(0))
+            self.logger.info(f"Number of rows in target after changes applied: {actual_total}")
+            if actual_total != final_total:
+                self.logger.warning(
+                    f"Saved row count was out by {final_total - actual_total}, using the actual count of {actual_total}."
+                )
+            expected_total = count_target - count_deletes + count_inserts
+            if expected_total != actual_total:
+                diff = expected_total - actual_total
+                self.logger.warning(
+                    f"Expected total of {expected_total} does not match actual final total {actual_total}. Out by {diff}"
+                )
+            final_total = actual_total
+            runs_since_row_count = 0
+        else:
+            self.logger.info(
+                f"Number of rows in target after changes applied (from the cursor counts): {final_total}"
             )
+        self.row_count = final_total
+        self.runs_since_row_count = runs_since_row_count
 
     @timing_decorator
-    def processUpdates(self):
-        """ 
-        Applies updates from the source to the target.
-        The source is a changeset with a __change__ field.
-        The target is expected to have the same schema.
-        """ 
-        self.logger.info(f"In the processUpdates function!")
-
+    def processUpserts(self, upsert_ids):
+        """
+        Applies the INSERT and UPDATE rows from the changeset to the
+        target in a single pass over the changeset.
+        A row updates the target if its id is already there, otherwise
+        it is inserted. Only the target rows for the changeset ids are
+        looked up, never the whole target.
+        Only editable fields found in both are copied, plus the geometry.
+        """
         source = str(self.changeset_fc)
         target = str(self.layer_feature_class)
 
-        source_desc = arcpy.da.Describe(source)
-        target_desc = arcpy.da.Describe(target)
-
-        source_fields = [field.name.lower() for field in source_desc.get("fields")]
-        target_fields = [field.name.lower() for field in target_desc.get("fields")]
-
-        self.logger.debug(f"Source fields: {source_fields}")
-        self.logger.debug(f"Target fields: {target_fields}")
-
-        # Exclude the GlobalID and OID fields
-        exclude_fields = [source_desc.get("globalIDFieldName"), source_desc.get("OIDFieldName"),
-                        target_desc.get("globalIDFieldName"), target_desc.get("OIDFieldName")]
-
-        source_fields = [f for f in source_fields if f not in exclude_fields]
-        target_fields = [f for f in target_fields if f not in exclude_fields]
-
-        # Identify date and text fields
-        date_fields = [f.name.lower() for f in target_desc.get("fields") if f.type == 'Date']
-        text_fields = [f.name.lower() for f in target_desc.get("fields") if f.type == 'String']
+        fields, date_flags, id_index, source_oid = self.getCopyPlan(source, target)
+
+        existing_ids = set()
+        for where_clause in self.idWhereClauses(target, upsert_ids):
+            with arcpy.da.SearchCursor(target, [self.id_field], where_clause=where_clause) as cursor:
+                existing_ids.update(row[0] for row in cursor)
+
+        # Inserts are written as the changeset is read. Only the ids of
+        # the updates are kept, so memory doesn't grow with the changeset.
+        change_clause = "__change__ IN ('INSERT', 'UPDATE')"
+        update_ids = set()
+        insert_count = 0
+        with arcpy.da.SearchCursor(
+            source, fields, where_clause=change_clause
+        ) as search_cursor, arcpy.da.InsertCursor(target, fields) as insert_cursor:
+            for row in search_cursor:
+                record_id = row[id_index]
+                if record_id in existing_ids:
+                    update_ids.add(record_id)
+                else:
+                    insert_cursor.insertRow(
+                        [parseLinzDatetime(v) if is_date else v for v, is_date in zip(row, date_flags)]
+                    )
+                    existing_ids.add(record_id)
+                    insert_count += 1
+
+        # Updates are applied a batch of ids at a time, reading back just
+        # that batch from the changeset through its id index. Rows are read in changeset order
+        # so the last change to an id wins. The where clauses are built for
+        # each feature class, as the id field type may differ between them.
+        order_by = (None, f"ORDER BY {source_oid}")
+        update_id_list = sorted(i for i in update_ids if i is not None)
+        for start in range(0, len(update_id_list), self.sql_batch_size):
+            batch_ids = update_id_list[start:start + self.sql_batch_size]
+            source_clause, = self.idWhereClauses(source, batch_ids)
+            target_clause, = self.idWhereClauses(target, batch_ids)
+            batch = {}
+            with arcpy.da.SearchCursor(
+                source, fields, where_clause=f"{change_clause} AND {source_clause}", sql_clause=order_by
+            ) as cursor:
+                for row in cursor:
+                    batch[row[id_index]] = row
+            with arcpy.da.UpdateCursor(target, fields, where_clause=target_clause) as cursor:
+                for r in cursor:
+                    row = batch.get(r[id_index])
+                    if row is not None:
+                        cursor.updateRow(
+                            [parseLinzDatetime(v) if is_date else v for v, is_date in zip(row, date_flags)]
+                        )
+
+        self.logger.debug("Inserted %s and updated %s records.", insert_count, len(update_ids))
+        return insert_count, len(update_ids)
+
+    @contextmanager
+    def editSession(self):
+        """
+        An edit session on the staging file geodatabase without an undo
+        stack, so nothing is kept for undoing bulk edits. The edits are
+        saved if the block succeeds and discarded if it raises.
+        Schema changes (AddField, DeleteField etc.) can't be made inside it.
+        """
+        editor = arcpy.da.Editor(str(self.staging_fgb))
+        editor.startEditing(with_undo=False, multiuser_mode=False)
+        editor.startOperation()
+        try:
+            yield editor
+        except Exception:
+            editor.abortOperation()
+            editor.stopEditing(save_changes=False)
+            raise
+        editor.stopOperation()
+        editor.stopEditing(save_changes=True)
+
+    def describe(self, path):
+        """
+        arcpy.da.Describe, cached per path for this run.
+        Anything that changes the schema of a feature class should
+        call forgetDescribe for it afterwards.
+        """
+        path = str(path)
+        if path not in self._describe_cache:
+            self._describe_cache[path] = arcpy.da.Describe(path)
+        return self._describe_cache[path]
 
-        # Store rows to be updated in a dictionary keyed by the record id
-        updates_dict = {}
-        with arcpy.da.SearchCursor(in_table=source, field_names=source_fields, where_clause="__change__ = 'UPDATE'") as cursor:
-            for row in cursor:
-                record_id = row[source_fields.index(self.id_field)]
-                updates_dict[record_id] = row
-        del cursor 
-
-        # Use a single UpdateCursor to apply updates in bulk
-        with arcpy.da.UpdateCursor(in_table=target, field_names=target_fields) as updateCursor:
-            for r in updateCursor:
-                record_id = r[target_fields.index(self.id_field)]
-                if record_id in updates_dict:
-                    row = updates_dict[record_id]
-                    for field in target_fields:
-                        val = row[source_fields.index(field)]
-                        if field in date_fields:
-                            dt = datetime.strptime(val, '%Y-%m-%dT%H:%M:%SZ')
-                            r[target_fields.index(field)] = dt
-                        else:
-                            r[target_fields.index(field)] = val
-                    updateCursor.updateRow(r)
-        del updateCursor
+    def forgetDescribe(self, path):
+        """Drop the cached Describe for path, if there is one."""
+        self._describe_cache.pop(str(path), None)
 
-        return
+    def getCopyPlan(self, source, target):
+        """
+        Work out the fields to copy from source to target: the geometry
+        plus the editable target fields that are also in the source.
+        Returns the field names, a date flag for each field, the position
+        of the id field and the OID field name of the source.
+        """
+        source_desc = self.describe(source)
+        source_fields = frozenset(f.name.lower() for f in source_desc.get("fields"))
+        # Shape_Length and Shape_Area are not editable, so are left out too.
+        target_fields = [
+            f for f in self.describe(target).get("fields")
+            if f.editable
+            and f.type not in _NON_COPY_FIELD_TYPES
+            and f.name.lower() in source_fields
+        ]
+        fields = ["SHAPE@"] + [f.name for f in target_fields]
+        date_flags = [False] + [f.type == "Date" for f in target_fields]
+        id_index = [f.lower() for f in fields].index(self.id_field.lower())
+        return fields, date_flags, id_index, source_desc.get("OIDFieldName")
 
+    def idWhereClauses(self, fc, ids):
+        """
+        Yield where clauses selecting the given ids from fc, at most
+        sql_batch_size ids per clause to stay under the IN list limits.
+        The ids are sorted so each batch covers a tight range of the
+        id index, and are quoted if the id field in fc is a text field.
+        The field type comes from the cached Describe, so it is worked
+        out again after forgetDescribe (e.g. once the id is converted).
+        """
+        id_is_text = any(
+            f.name.lower() == self.id_field.lower() and f.type == "String"
+            for f in self.describe(fc).get("fields")
+        )
+        if id_is_text:
+            values = sorted("'{}'".format(str(i).replace("'", "''")) for i in ids if i is not None)
+        else:
+            values = list(map(str, sorted(i for i in ids if i is not None)))
+        for start in range(0, len(values), self.sql_batch_size):
+            batch = values[start:start + self.sql_batch_size]
+            yield f"{self.id_field} IN ({','.join(batch)})"
 
-    def deleteFeaturesNotIntersectingExtent(self, fc):
+    def deleteFeaturesNotMatching(self, fc):
         """
         Delete all features in the given feature class that
-        don't intersect the extent.
+        don't intersect the extent or don't match the SQL filter.
+        Both tests are made in a single UpdateCursor pass. The features
+        matching the SQL filter, and those intersecting the extent, are
+        found first by their object ids using the geodatabase's own
+        attribute and spatial filtering.
         """
         if fc is None:
-            return 
+            return
 
         self.getExtentGeometry()
-        if self.extent_geometry is None:
+        extent_geometry = self.extent_geometry
+        if extent_geometry is None and self.sql_filter is None:
             return
 
-        self.logger.info(f"Deleting all feature that don't intersect the extent")
+        self.logger.info(f"Deleting all features outside the extent or not matching the SQL expression")
         self.logger.info(fc)
-        lyr = arcpy.management.MakeFeatureLayer(
-            in_features=str(fc), out_layer="temp_layer"
-        )
-        arcpy.management.SelectLayerByLocation(
-            lyr,
-            overlap_type="INTERSECT",
-            select_features=str(self.extent_featureclass),
-            invert_spatial_relationship="INVERT",
-        )
-        arcpy.management.DeleteRows(lyr)
-        arcpy.Delete_management(lyr)
-        return
-
+        fc = str(fc)
 
-    def deleteFeaturesNotMatchingSQL(self, fc):
-        """
-        Delete all features in the given feature class that
-        don't match the given SQL where_clause.
-        """
-        if fc is None:
-            return 
-        if self.sql_filter is None:
-            return
-        self.logger.info(f"Deleting all features that don't match the given SQL expression")
-        lyr = arcpy.management.MakeFeatureLayer(
-            in_features=str(fc), out_layer="temp_layer"
-        )
-        arcpy.management.SelectLayerByAttribute(
-            in_layer_or_view=lyr, where_clause=self.sql_filter, invert_where_clause="INVERT"
-        )
-        arcpy.management.DeleteRows(lyr)
-        arcpy.Delete_management(lyr)
+        matching_oids = None
+        if self.sql_filter is not None:
+            with arcpy.da.SearchCursor(fc, ["OID@"], where_clause=self.sql_filter) as cursor:
+                matching_oids = {row[0] for row in cursor}
+
+        fields = ["OID@"]
+        intersecting_oids = None
+        if extent_geometry is not None:
+            spatial_reference = self.describe(fc).get("spatialReference")
+            if (
+                spatial_reference is not None
+                and spatial_reference.factoryCode != extent_geometry.spatialReference.factoryCode
+            ):
+                extent_geometry = extent_geometry.projectAs(spatial_reference)
+            try:
+                # Let the geodatabase find the intersecting features, so its
+                # spatial index rules out most of them by bounding box first.
+                with arcpy.da.SearchCursor(
+                    fc, ["OID@"], spatial_filter=extent_geometry, spatial_relationship="INTERSECTS"
+                ) as cursor:
+                    intersecting_oids = {row[0] for row in cursor}
+            except TypeError:
+                # spatial_filter needs ArcGIS Pro 3.2 or later. Otherwise the
+                # extent geometry is already in memory, so test each feature
+                # against it directly, checking the bounding boxes first.
+                fields.append("SHAPE@")
+                envelope = extent_geometry.extent
+
+        deleted = 0
+        with self.editSession(), arcpy.da.UpdateCursor(fc, fields) as cursor:
+            for row in cursor:
+                if matching_oids is not None and row[0] not in matching_oids:
+                    outside = True
+                elif intersecting_oids is not None:
+                    outside = row[0] not in intersecting_oids
+                elif extent_geometry is not None:
+                    geometry = row[1]
+                    outside = (
+                        geometry is None
+                        or geometry.extent.disjoint(envelope)
+                        or geometry.disjoint(extent_geometry)
+                    )
+                else:
+                    outside = False
+                if outside:
+                    cursor.deleteRow()
+                    deleted += 1
+        self.logger.debug("Deleted %s features outside the extent or not matching the SQL expression.", deleted)
         return
 
 
@@ -878,15 +1545,10 @@ class LINZDataset:
             self.logger.info(
                 f"{self.id_field} is already an integer data type, no need to convert the data type"
             )
-            arcpy.management.AddIndex(
-                in_table=fc,
-                fields=self.id_field,
-                index_name="id_idx2",
-                unique="UNIQUE",
-                ascending="NON_ASCENDING",
-            )
             return
 
+        # Copy the ids into a new integer field in a single cursor pass,
+        # then drop the original field and rename the new one in its place.
         temp_fieldname = "_uniqueIdentifier"
         arcpy.management.AddField(
             in_table=fc,
@@ -895,61 +1557,61 @@ class LINZDataset:
             field_is_nullable="NULLABLE",
             field_is_required="NON_REQUIRED",
         )
-        arcpy.management.CalculateField(
-            in_table=fc,
-            field=temp_fieldname,
-            expression=f"!{self.id_field}!",
-            expression_type="PYTHON3",
-            code_block="",
-            field_type="TEXT",
-            enforce_domains="NO_ENFORCE_DOMAINS",
-        )
+        with self.editSession(), arcpy.da.UpdateCursor(fc, [self.id_field, temp_fieldname]) as cursor:
+            for row in cursor:
+                row[1] = int(row[0]) if row[0] is not None else None
+                cursor.updateRow(row)
         arcpy.management.DeleteField(
             in_table=fc, drop_field=self.id_field, method="DELETE_FIELDS"
         )
-        arcpy.management.AddField(
+        arcpy.management.AlterField(
             in_table=fc,
-            field_name=self.id_field,
-            field_type="LONG",
-            field_is_nullable="NULLABLE",
-            field_is_required="NON_REQUIRED",
+            field=temp_fieldname,
+            new_field_name=self.id_field,
+            new_field_alias=self.id_field,
         )
+
+        self.forgetDescribe(fc)
+        self.logger.info(f"Finished converting id field to integer.")
+        return fc
+
+    def indexIdField(self, fc, unique=True):
+        """
+        Add an index on the id field, if there isn't one already.
+        This should be called once the bulk load into a feature class
+        has finished, so the inserts don't pay for maintaining the index.
+        The layer feature class gets a unique index. The changeset can
+        have more than one change for an id, so its index is not unique;
+        processUpserts reads it back a batch of update ids at a time.
+        """
+        fc = str(fc)
+        for index in arcpy.ListIndexes(fc):
+            if any(f.name.lower() == self.id_field.lower() for f in index.fields):
+                self.logger.debug("%s is already indexed in %s", self.id_field, fc)
+                return
+        self.logger.info(f"Adding index on {self.id_field} in {fc}")
         arcpy.management.AddIndex(
             in_table=fc,
             fields=self.id_field,
             index_name="id_idx2",
-            unique="UNIQUE",
+            unique="UNIQUE" if unique else "NON_UNIQUE",
             ascending="NON_ASCENDING",
         )
-        arcpy.management.CalculateField(
-            in_table=fc,
-            field=self.id_field,
-            expression=f"!{temp_fieldname}!",
-            expression_type="PYTHON3",
-            code_block="",
-            field_type="TEXT",
-            enforce_domains="NO_ENFORCE_DOMAINS",
-        )
-        arcpy.management.DeleteField(
-            in_table=fc, drop_field=temp_fieldname, method="DELETE_FIELDS"
-        )
-
-        self.logger.info(f"Finished converting id field to integer.")
-        return fc
 
     def update_last_updated_file(self, update_time=None):
         """
         Updates the last_updated.json file for the
         current configuration being processed.
-        update_time is an ISO date string in UTC.
+        update_time is an optional datetime, defaulting to now.
+        It is written as an ISO date string in UTC.
         """
-        if isinstance(update_time, datetime):
-            update_time = f"{update_time.isoformat()}Z"
-        else:
-            update_time = f"{datetime.utcnow().isoformat()}Z"
+        update_time = formatLinzDatetime(update_time)
 
-        with open(self.last_updated_file, "w") as file:
-            json.dump({"last_updated": update_time}, file)
+        data = {"last_updated": update_time}
+        if self.row_count is not None:
+            data["row_count"] = self.row_count
+            data["runs_since_row_count"] = self.runs_since_row_count
+        saveJson(self.last_updated_file, data)
         self.logger.info(f"The last updated file has been set to: {update_time}")
         return
 
@@ -957,22 +1619,97 @@ class LINZDataset:
         """
         Fetch the first record from the extent_featureclass
         in the staging file geodatabase.
+        The result, including no extent, is remembered so the
+        feature class is only read once.
         """
-        if self.extent_geometry is not None:
+        if self.extent_geometry_read:
             return self.extent_geometry
 
-        extent_records = [
-            row[0] for row in arcpy.da.SearchCursor(str(self.extent_featureclass), ["SHAPE@"])
-        ]
-        if len(extent_records) == 0:
-            self.extent_geometry = None
-        else:
-            self.extent_geometry = extent_records[0]
+        with arcpy.da.SearchCursor(str(self.extent_featureclass), ["SHAPE@"]) as cursor:
+            self.extent_geometry = next((row[0] for row in cursor), None)
+        self.extent_geometry_read = True
         return self.extent_geometry
 
-    def geometryToGeojson(self, in_geometry):
+    def getBboxTiles(self):
+        """
+        Split the extent into a list of BBOX strings so a large area
+        can be requested as several smaller WFS requests.
+        Each tile is halved in both directions until its area is no
+        more than max_tile_area (square kilometers). Tiles that don't
+        touch the extent geometry are dropped.
+        Raises LINZError if that would make more than max_tiles tiles.
+        """
+        self.getExtentGeometry()
+        if self.extent_geometry is None:
+            return []
+        if not self.max_tile_area:
+            return [
+                self.geometryToBboxString(self.getExtentGeometryWgs84(), already_wgs84=True)
+            ]
+
+        max_area = self.max_tile_area * 1000000  # extent is in NZTM meters
+        extent = self.extent_geometry.extent
+        spatial_reference = self.extent_geometry.spatialReference
+        # Every tile is split to the same depth, so the tile count is
+        # known before any are made.
+        tile_area = (extent.XMax - extent.XMin) * (extent.YMax - extent.YMin)
+        tile_count = 1
+        while tile_area > max_area:
+            tile_area /= 4
+            tile_count *= 4
+        if tile_count > self.max_tiles:
+            raise LINZError(
+                f"max_tile_area of {self.max_tile_area} square kilometers would split the extent into {tile_count} tiles, more than the limit of {self.max_tiles}. Use a larger max_tile_area."
+            )
+        pending = [(extent.XMin, extent.YMin, extent.XMax, extent.YMax)]
+        tiles = []
+        while pending:
+            xmin, ymin, xmax, ymax = pending.pop()
+            if (xmax - xmin) * (ymax - ymin) > max_area:
+                xmid = (xmin + xmax) / 2
+                ymid = (ymin + ymax) / 2
+                pending.extend([
+                    (xmin, ymin, xmid, ymid),
+                    (xmid, ymin, xmax, ymid),
+                    (xmin, ymid, xmid, ymax),
+                    (xmid, ymid, xmax, ymax),
+                ])
+                continue
+            tile = arcpy.Polygon(
+                arcpy.Array([
+                    arcpy.Point(xmin, ymin),
+                    arcpy.Point(xmin, ymax),
+                    arcpy.Point(xmax, ymax),
+                    arcpy.Point(xmax, ymin),
+                    arcpy.Point(xmin, ymin),
+                ]),
+                spatial_reference,
+            )
+            if not tile.disjoint(self.extent_geometry):
+                tiles.append(self.geometryToBboxString(tile))
+        return tiles
+
+    def getExtentGeometryWgs84(self):
+        """
+        The extent geometry projected to WGS84, projected once
+        on first use and then reused.
+        """
+        if self.extent_geometry_wgs84 is not None:
+            return self.extent_geometry_wgs84
+        self.getExtentGeometry()
+        if self.extent_geometry is not None:
+            self.extent_geometry_wgs84 = self.extent_geometry.projectAs(
+                getWgs84SpatialReference()
+            )
+        return self.extent_geometry_wgs84
+
+    def geometryToGeojson(self, in_geometry, already_wgs84=False):
         """
+        Uses the geometry's __geo_interface__ where available, otherwise
+        falls back to building the GeoJSON part by part, from
         https://github.com/jasonbot/geojson-madness/blob/master/geojson_out.py#L22-58
+        Pass already_wgs84=True if in_geometry has already been
+        projected to WGS84 to skip projecting it again.
         """
 
         def part_split_at_nones(part_items):
@@ -987,11 +1724,22 @@ class LINZDataset:
             if current_part:
                 yield current_part
 
-        in_geometry = in_geometry.projectAs(arcpy.SpatialReference(4326))
-
         if in_geometry is None:
             return None
-        elif isinstance(in_geometry, arcpy.PointGeometry):
+        if not already_wgs84:
+            in_geometry = in_geometry.projectAs(getWgs84SpatialReference())
+
+        # arcpy geometries build their own GeoJSON mapping, which avoids
+        # walking every vertex in Python. The json round trip turns the
+        # coordinate tuples into plain lists, and is done by orjson if
+        # it is installed.
+        geo_interface = getattr(in_geometry, "__geo_interface__", None)
+        if geo_interface is not None:
+            if orjson is not None:
+                return orjson.loads(orjson.dumps(geo_interface))
+            return json.loads(json.dumps(geo_interface))
+
+        if isinstance(in_geometry, arcpy.PointGeometry):
             pt = in_geometry.getPart(0)
             return {"type": "Point", "coordinates": (pt.X, pt.Y)}
         elif isinstance(in_geometry, arcpy.Polyline):
@@ -1024,60 +1772,169 @@ class LINZDataset:
             logger.info("No retain_after_purge number specified, skipping purge.")
             return
 
-        # Delete changeset json files
-        self.logger.info("Purging old changeset json files")        
-        json_files = list(self.changeset_directory.glob("*.json"))
-        json_files.sort(key=lambda x: os.path.getctime(x), reverse=True)
-        files_to_delete = json_files[self.retain_after_purge:]
-        for file in files_to_delete:
-            try:
-                file.unlink()  # Delete the file
-                self.logger.debug(f"Deleted: {file}")
-            except Exception as e:
-                self.logger.warning(f"Error deleting {file}: {e}")
-
-        # Delete full download zip files
-        self.logger.info("Purging old full download zip files")
+        # Delete changeset json files and full download zip files together,
+        # so the deletes from both folders share the one thread pool.
+        self.logger.info("Purging old changeset json files and full download zip files")
         full_directory = self.layer_data_directory / "full"
-        zip_files = list(full_directory.glob("*.zip"))
-        zip_files.sort(key=lambda x: os.path.getctime(x), reverse=True)
-        files_to_delete = zip_files[self.retain_after_purge:]
-        for file in files_to_delete:
-            try:
-                file.unlink()  # Delete the file
-                self.logger.debug(f"Deleted: {file}")
-            except Exception as e:
-                self.logger.warning(f"Error deleting {file}: {e}")
+        files_to_delete = self.filesToPurge(self.changeset_directory, ".json")
+        files_to_delete += self.filesToPurge(full_directory, ".zip")
+        self.deleteFiles(files_to_delete)
 
         # Delete changeset feature classes
         staging_fgb = self.layer_data_directory / self.staging_fgb_name
         arcpy.env.workspace = str(staging_fgb)
-        feature_classes = arcpy.ListFeatureClasses()
-
-        # Filter feature classes that contain "changeset" in their names
+        # Let the geodatabase filter for feature classes with "changeset" in their names
         self.logger.info("Purging old changeset feature classes")
-        changeset_feature_classes = [fc for fc in feature_classes if "changeset" in fc]
-        changeset_feature_classes.sort()
+        changeset_feature_classes = sorted(arcpy.ListFeatureClasses("*changeset*") or [])
         feature_classes_to_delete = changeset_feature_classes[:-self.retain_after_purge]
         for fc in feature_classes_to_delete:
             try:
                 arcpy.Delete_management(fc)
-                self.logger.debug(f"Deleted: {fc}")
+                self.logger.debug("Deleted: %s", fc)
             except Exception as e:
                 self.logger.warning(f"Error deleting {fc}: {e}")
         return
 
+    def deleteFiles(self, files, max_workers=8):
+        """
+        Delete files, several at a time since each delete mostly waits
+        on the file system. Failures are logged rather than raised.
+        """
+        def delete(file):
+            try:
+                file.unlink()  # Delete the file
+                self.logger.debug("Deleted: %s", file)
+            except Exception as e:
+                self.logger.warning(f"Error deleting {file}: {e}")
+
+        if not files:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(delete, files))
+
+    def filesToPurge(self, directory, suffix):
+        """
+        Return the files in directory ending with suffix, other than
+        the newest retain_after_purge of them.
+        The creation times come from a single scandir pass, rather than
+        a separate stat call for every file.
+        """
+        if not directory.is_dir():
+            return []
+        with os.scandir(directory) as entries:
+            files = [
+                (entry.stat().st_ctime, entry.path)
+                for entry in entries
+                if entry.name.endswith(suffix) and entry.is_file()
+            ]
+        # Only the oldest files beyond those retained are needed, not a full sort.
+        oldest = heapq.nsmallest(max(0, len(files) - self.retain_after_purge), files)
+        return [Path(path) for _, path in oldest]
+
     @staticmethod
-    def geometryToBboxString(in_geometry):
+    def geometryToBboxString(in_geometry, already_wgs84=False):
         """
         Convert a geometry to a BBOX string.
         XMin,YMin,XMax,YMax,EPSG:wkid
+        Pass already_wgs84=True to skip projecting to WGS84.
         """
-        in_geometry = in_geometry.projectAs(arcpy.SpatialReference(4326))
+        if not already_wgs84:
+            in_geometry = in_geometry.projectAs(getWgs84SpatialReference())
         extent = in_geometry.extent
         bbox_string = f"{extent.XMin},{extent.YMin},{extent.XMax},{extent.YMax},EPSG:{extent.spatialReference.factoryCode}"
         return bbox_string
 
+    @staticmethod
+    def streamResponseToFile(response, out_file, buffer_size=1024 * 1024):
+        """
+        Write a streamed response body to a file in 1 MiB blocks.
+        shutil does the copying in C rather than looping over small
+        chunks in Python. The response must be made with stream=True.
+        Any Content-Encoding (e.g. gzip) is undone as it is read.
+        """
+        response.raw.decode_content = True
+        with open(out_file, "wb", buffering=buffer_size) as file:
+            shutil.copyfileobj(response.raw, file, length=buffer_size)
+        return out_file
+
+    @staticmethod
+    def readChangesetHeader(json_file, scan_bytes=65536):
+        """
+        Read the numberReturned and timeStamp members of a WFS
+        GeoJSON FeatureCollection without parsing the features.
+        GeoServer writes these after the features array, so the
+        end of the file is checked first and then the start.
+        Returns a tuple of (number_returned, time_stamp), either of
+        which is None if not found (e.g. an XML error response).
+        """
+        json_file = Path(json_file)
+        size = json_file.stat().st_size
+        with open(json_file, "rb") as file:
+            file.seek(max(0, size - scan_bytes))
+            tail = file.read()
+            file.seek(0)
+            head = file.read(min(size, scan_bytes))
+
+        number_returned = None
+        time_stamp = None
+        # Take the last match in the tail and the first match in the head,
+        # as these are the ones outside of the features array.
+        for chunk, pick in ((tail, -1), (head, 0)):
+            if number_returned is None:
+                matches = _NUMBER_RETURNED_RE.findall(chunk)
+                if matches:
+                    number_returned = int(matches[pick])
+            if time_stamp is None:
+                matches = _TIMESTAMP_RE.findall(chunk)
+                if matches:
+                    time_stamp = matches[pick].decode("utf-8")
+        return number_returned, time_stamp
+
+    @staticmethod
+    def iterGeojsonFeatures(json_file, chunk_size=1024 * 1024):
+        """
+        Yield the features of a GeoJSON FeatureCollection one at a
+        time, reading the file in chunks so the whole collection is
+        never held in memory. Expects the features array to be the
+        first one in the file, which is how GeoServer writes it.
+        """
+        decoder = json.JSONDecoder()
+        with open(json_file, "r", encoding="utf-8") as file:
+            buffer = ""
+            match = None
+            while match is None:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    raise LINZError(f"No features found in {json_file}.")
+                buffer += chunk
+                match = _FEATURES_START_RE.search(buffer)
+
+            buffer = buffer[match.end():]
+            position = 0
+            eof = False
+            while True:
+                # Skip the whitespace and commas between features.
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if position < len(buffer) and buffer[position] == "]":
+                    return
+                feature = None
+                if position < len(buffer):
+                    try:
+                        feature, position = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        # Most likely a feature split across chunks.
+                        feature = None
+                if feature is not None:
+                    yield feature
+                    continue
+                if eof:
+                    raise LINZError(f"Unexpected end of features in {json_file}.")
+                chunk = file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+
     @staticmethod
     def slugify(text):
         """
@@ -1086,16 +1943,7 @@ class LINZDataset:
         """
         if text is None or not isinstance(text, str):
             return text
-        text = text.strip()
-        # Define a translation table to replace invalid characters with an underscore
-        invalid_chars = '-<>:"/\\|?*'
-        translation_table = str.maketrans(invalid_chars, "_" * len(invalid_chars))
-        # Translate the text to replace invalid characters
-        text = text.translate(translation_table)
-        # Replace spaces with underscores
-        text = text.replace(" ", "_")
-        # Remove any remaining characters that are not alphanumeric, underscore, or hyphen
-        text = re.sub(r"[^a-zA-Z0-9_-]", "", text)
+        text = text.strip().translate(_SLUG_TABLE)
         # Add an underscore in front if the first character is a digit
         # This ensures it can also be used as a feature class name.
         if text and text[0].isdigit():
@@ -1160,38 +2008,40 @@ if __name__ == "__main__":
         help="A user specified friendly name for this download. Use file and folder friendly text, avoid special characters and spaces.",
     )
     parser.add_argument(
+        "-p",
+        "--purge",
+        action="store_true",
+        help="Flag indicating whether to purge old changesets.",
+    )
+    # Only one action can be taken per run, argparse rejects any combination.
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
         "-i",
         "--init",
         action="store_true",
         help="Flag to initialise a data folder, create config file and staging.gdb but don't download anything.",
     )
-    parser.add_argument(
+    mode.add_argument(
         "-c",
         "--changeset",
         action="store_true",
         help="Flag indicating to download the layer changeset.",
     )
-    parser.add_argument(
-        "-p",
-        "--purge",
-        action="store_true",
-        help="Flag indicating whether to purge old changesets.",
-    )
-    parser.add_argument(
+    mode.add_argument(
         "-d",
         "--download",
         action="store_true",
         help="Flag indicating to download the full layer dataset.",
     )
-    parser.add_argument(
+    mode.add_argument(
         "-r", "--resume", help="Resume polling for a previous full export attempt."
     )
-    parser.add_argument(
+    mode.add_argument(
         "-lf",
         "--localfull",
         help="Process an already downloaded zip file. Provide the full path to the zip file with this option.",
     )
-    parser.add_argument(
+    mode.add_argument(
         "-lc",
         "--localchangeset",
         help="Process an already downloaded changes json file. Provide the full path to the json file with this option.",